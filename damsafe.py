@@ -1,19 +1,19 @@
 import random
 import sqlite3
 import threading
-import os
 import time
-from datetime import datetime
-from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from functools import lru_cache
 
 import click
 import humanize
 from pymodbus.client.sync import ModbusTcpClient
 from pymodbus.exceptions import ConnectionException
 from pymodbus.pdu import ModbusExceptions
-from filelock import FileLock
 from flask import (
-    Flask, render_template, redirect, url_for, request, g, flash
+    Flask, render_template, redirect, url_for, request, g, flash,
+    make_response
 )
 from flask.cli import with_appcontext
 
@@ -21,6 +21,54 @@ from flask.cli import with_appcontext
 app = Flask(__name__)
 app.secret_key = 'dev'
 
+# tuning applied to every database connection: WAL journaling so the
+# dashboard's readers never block the server's writes, plus cheaper
+# commits and a larger in-memory page cache
+DB_PRAGMAS = ('PRAGMA journal_mode=WAL; PRAGMA synchronous=NORMAL; '
+              'PRAGMA temp_store=memory; PRAGMA cache_size=-64000;')
+
+# the /data table query: each device joined to its most recent status
+# row, carrying the overall last-check time along; kept as one constant
+# string object so sqlite3's statement cache always hits
+DATA_SQL = ('SELECT d.id,d.name,d.ip,d.coil,s.time AS status_time,'
+            's.status AS status,s.error AS error,'
+            'CASE WHEN s.status THEN s.time END AS seen_time,'
+            '(SELECT MAX(time) FROM device_status) AS last_check '
+            'FROM device AS d LEFT JOIN '
+            '(SELECT device_id,status,error,time,'
+            'ROW_NUMBER() OVER (PARTITION BY device_id ORDER BY time DESC) AS rn '
+            'FROM device_status) AS s '
+            'ON s.device_id = d.id AND s.rn = 1')
+
+# run a write transaction, retrying with a short backoff if another
+# connection holds the write lock longer than SQLite's own busy wait
+def retry_locked(write):
+    for delay in (0.01, 0.05, 0.25):
+        try:
+            return write()
+        except sqlite3.OperationalError as e:
+            if 'locked' not in str(e):
+                raise
+            time.sleep(delay)
+    return write()
+
+
+# turn a whole number of seconds into a plain-english duration; rows
+# sharing the same coarse age reuse the cached string instead of going
+# through humanize's locale machinery again
+@lru_cache(maxsize=1024)
+def _humanize_secs(secs):
+    return humanize.naturaldelta(timedelta(seconds=secs))
+
+
+# turn a UTC timestamp into a plain-english "how long ago", lazily
+# per rendered cell instead of eagerly in the /data loop
+@app.template_filter('humandelta')
+def humandelta(when):
+    secs = int((datetime.utcnow() - when).total_seconds())
+    return _humanize_secs(secs)
+
+
 # redirect to dashboard
 @app.route('/')
 def index():
@@ -49,15 +97,16 @@ def add():
     ).fetchone() is not None:
         error = 'Device name is already taken.'
 
-    # if no error, take the database lock, insert new device
-    # and redirect to dashboard
+    # if no error, insert the new device and redirect to dashboard
+    # (the connection commits on leaving the with-block)
     if error is None:
-        with FileLock('db.lock'):
-            db.execute(
-                'INSERT INTO device (name, ip, coil) VALUES (?, ?, ?)',
-                (name, ip, coil)
-            )
-            db.commit()
+        def insert():
+            with db:
+                db.execute(
+                    'INSERT INTO device (name, ip, coil) VALUES (?, ?, ?)',
+                    (name, ip, coil)
+                )
+        retry_locked(insert)
         return redirect(url_for('dashboard'))
 
     # otherwise, flash the error and redirect to dashboard
@@ -68,112 +117,179 @@ def add():
 # remove a route 
 @app.route('/remove', methods=['POST'])
 def remove():
-    # get the database and database lock, remove device,
-    # and redirect to dashboard
+    # get the database, remove the device, and redirect to dashboard
     db = get_db()
-    with FileLock('db.lock'):
-        name = request.form['name']
-        db.execute('DELETE FROM device WHERE name = ?', (name,))
-        db.commit()
+    name = request.form['name']
+
+    def delete():
+        with db:
+            db.execute('DELETE FROM device WHERE name = ?', (name,))
+    retry_locked(delete)
     return redirect(url_for('dashboard'))
 
 
+# short-lived cache of the built data table, so a burst of reads
+# (several open dashboard tabs) only builds it once
+_data_cache = {'ts': 0, 'etag': None, 'rows': None, 'server_status': None,
+               'last_check': None}
+
+
 # form data table (reloaded dynamically on dashboard)
 @app.route('/data', methods=['GET'])
 def data():
-    # get database and all devices
+    # get the database
     db = get_db()
-    db_rows = db.execute('SELECT statid.*,ds.status AS status,ds.error AS error,dsup.time AS seen_time '
-                         'FROM (SELECT dev.id,dev.name,dev.ip,dev.coil,MAX(ds.time) AS status_time '
-                         'FROM device AS dev LEFT OUTER JOIN device_status AS ds ON ds.device_id = dev.id '
-                         'GROUP BY dev.id) AS statid LEFT OUTER JOIN device_status AS ds '
-                         'ON ds.device_id = statid.id AND ds.time = statid.status_time '
-                         'LEFT OUTER JOIN device_status AS dsup '
-                         'ON dsup.device_id = statid.id AND dsup.time = statid.status_time AND dsup.status = True').fetchall()
-
-    # for every database row, parse into plain english
+
+    # the table only changes when a status row lands or a device is
+    # added/removed, so those two values make a cheap ETag--if the
+    # client already has this version, skip the join entirely
+    latest, device_count = db.execute(
+        'SELECT MAX(time), (SELECT COUNT(*) FROM device) FROM device_status'
+    ).fetchone()
+    etag = '{}-{}'.format(latest, device_count)
+    if request.if_none_match.contains(etag):
+        return '', 304
+
+    # if another request built the table in the last couple of seconds,
+    # serve that--the server only polls every 5 seconds anyway; tag it
+    # with the etag from when it was built, not the fresh one, so a
+    # client can never pair stale rows with a current tag
+    if time.time() - _data_cache['ts'] < 2:
+        if request.if_none_match.contains(_data_cache['etag']):
+            return '', 304
+        g.device_rows = _data_cache['rows']
+        g.server_status = _data_cache['server_status']
+        g.last_status_check = _data_cache['last_check']
+        response = make_response(render_template('data.html'))
+        response.set_etag(_data_cache['etag'])
+        return response
+
+    # get all devices--as plain tuples, since this loop indexes each
+    # row enough times that Row's name lookups add up
+    cursor = db.execute(DATA_SQL)
+    cursor.row_factory = None
+    db_rows = cursor.fetchall()
+
+    # for every database row, gather what the template needs; the
+    # up/down wording and "how long ago" formatting happen lazily in
+    # data.html via the humandelta filter; one timestamp serves the
+    # whole pass rather than a fresh utcnow() per row
+    now = datetime.utcnow()
     g.device_rows = []
-    for db_row in db_rows:
-        # set hover texts to None
+    for device_id, name, ip, coil, status_time, status, error, seen_time, _ in db_rows:
+        uptime = None
         uptime_hover = 'no precise time'
-        lastseen_hover = 'no precise time'
-
-        # if device not seen yet, wait
-        if db_row['status'] is None:
-            status = '...'
-            uptime = '...'
-            lastseen = '...'
+        lastseen_time = None
 
-        # if device is up, say so
-        elif db_row['status'] == 1:
-            status = 'up'
+        # if the device is up, work out its uptime here--it takes
+        # extra queries the template can't run
+        if status == 1:
             # if we've not seen it before, it just started
-            if db_row['seen_time'] is None:
+            if seen_time is None:
                 uptime = 'just started'
             # uptime is time last seen minus current time
             else:
                 lastdowntime = db.execute('SELECT device.*,MAX(device_status.time) AS time FROM device '
                                           'LEFT OUTER JOIN device_status ON device_status.device_id = device.id '
                                           'WHERE device_status.status = false').fetchone()['time']
-                startofuptime = db.execute('SELECT device.*,MIN(device_status.time) AS time FROM device '
-                                           'LEFT OUTER JOIN device_status ON device_status.device_id = device.id '
-                                           'WHERE time > ?', (lastdowntime,)).fetchone()['time']
-                uptime = str(datetime.utcnow() - datetime.strptime(startofuptime, '%Y-%m-%d %H:%M:%S')).split('.')[0]
-                uptime_hover = 'UTC ' + startofuptime
-            lastseen = 'now'
-
-        # otherwise, say it's down
-        else:
-            status = 'down'
-            uptime = 'n/a'
+                # if no down row survives (retention may have pruned
+                # them all), count from the oldest row we still have
+                if lastdowntime is None:
+                    startofuptime = db.execute('SELECT MIN(time) AS time '
+                                               'FROM device_status').fetchone()['time']
+                else:
+                    startofuptime = db.execute('SELECT device.*,MIN(device_status.time) AS time FROM device '
+                                               'LEFT OUTER JOIN device_status ON device_status.device_id = device.id '
+                                               'WHERE time > ?', (lastdowntime,)).fetchone()['time']
+                if startofuptime is None:
+                    uptime = 'just started'
+                else:
+                    started = datetime.utcfromtimestamp(startofuptime)
+                    secs = int((now - started).total_seconds())
+                    uptime = '{}:{:02}:{:02}'.format(secs // 3600, (secs // 60) % 60, secs % 60)
+                    uptime_hover = 'UTC {}'.format(started)
+
+        # if it's down, find when it was last up (may be never)
+        elif status == 0:
             seentime = db.execute('SELECT device.*,MAX(device_status.time) AS time FROM device '
                                   'LEFT OUTER JOIN device_status ON device_status.device_id = device.id '
                                   'WHERE device_status.status = true').fetchone()['time']
-
-            # if we've never seen it, say so
-            if seentime is None:
-                print(db_row['seen_time'])
-                print(db_row.keys())
-                lastseen = 'never'
-
-            # otherwise time since last seen is current time minus last seen time
-            else:
-                lastseen = humanize.naturaldelta(datetime.utcnow() - datetime.strptime(seentime, '%Y-%m-%d %H:%M:%S'))
-                lastseen_hover = 'UTC ' + seentime
-
-        # if no error, say so--otherwise get the error text
-        error = 'none' if db_row['error'] is None else db_row['error']
+            if seentime is not None:
+                lastseen_time = datetime.utcfromtimestamp(seentime)
 
         # add the row to the table
         device_row = {
-            'name':             db_row['name'],
-            'ip':               db_row['ip'],
-            'coil':             db_row['coil'],
+            'name':             name,
+            'ip':               ip,
+            'coil':             coil,
             'error':            error,
-            'status':           status,
+            'status_raw':       status,
             'uptime':           uptime,
             'uptime_hover':     uptime_hover,
-            'lastseen':         lastseen,
-            'lastseen_hover':   lastseen_hover
+            'lastseen_time':    lastseen_time
         }
         g.device_rows.append(device_row)
 
-    try:
-        # if the server is up, check when it last touched `server_alive`
-        # if it's within the last 10 seconds, the server is alive
-        mtime = os.path.getmtime('server_alive')
-        alive = (time.time() - mtime < 10)
-    except FileNotFoundError:
-        # but if the file isn't there, it's definitely dead
-        alive = False
+    # if the server has beaten its heart within the last 10 seconds,
+    # it's alive--if there's no heartbeat row, it's definitely dead
+    heartbeat = db.execute("SELECT (julianday('now') - julianday(ts)) * 86400 AS age "
+                           'FROM heartbeat WHERE id = 1').fetchone()
+    alive = heartbeat is not None and heartbeat['age'] is not None and heartbeat['age'] < 10
     g.server_status = 'Alive' if alive else 'Dead'
 
-    # get the last time a device was checked, and say how long ago that was
-    statustime = db.execute('SELECT MAX(time) AS time FROM device_status').fetchone()['time']
-    g.last_status_check = 'Never' if statustime is None else humanize.naturaldelta(datetime.utcnow() - datetime.strptime(statustime, '%Y-%m-%d %H:%M:%S'))
-
-    # serve up the table
-    return render_template('data.html')
+    # get the last time a device was checked, and say how long ago that
+    # was; the main query already carried the value along, so only an
+    # empty device table needs its own lookup
+    if db_rows:
+        statustime = db_rows[0][8]
+    else:
+        statustime = db.execute('SELECT MAX(time) AS time FROM device_status').fetchone()['time']
+    g.last_status_check = 'Never' if statustime is None else _humanize_secs(int((now - datetime.utcfromtimestamp(statustime)).total_seconds()))
+
+    # remember what we built for any reads hot on this one's heels
+    _data_cache['etag'] = etag
+    _data_cache['rows'] = g.device_rows
+    _data_cache['server_status'] = g.server_status
+    _data_cache['last_check'] = g.last_status_check
+    _data_cache['ts'] = time.time()
+
+    # serve up the table, tagged so unchanged polls can get a 304
+    response = make_response(render_template('data.html'))
+    response.set_etag(etag)
+    return response
+
+
+# event stream that nudges the dashboard whenever fresh status data
+# lands, so clients don't have to poll /data on a blind timer
+@app.route('/data/stream', methods=['GET'])
+def data_stream():
+    def stream():
+        # the generator outlives the request context, so it gets its
+        # own connection rather than going through get_db
+        db = sqlite3.connect(
+            'damsafe.sqlite',
+            detect_types=(sqlite3.PARSE_DECLTYPES |
+                          sqlite3.PARSE_COLNAMES)
+        )
+        db.executescript(DB_PRAGMAS)
+
+        # send an event on connect and then only when the latest
+        # status time moves, once per server poll cycle at most;
+        # close up the connection once the client goes away
+        try:
+            last = False
+            while True:
+                latest = db.execute('SELECT MAX(time) FROM device_status').fetchone()[0]
+                if latest != last:
+                    last = latest
+                    yield 'data: {}\n\n'.format(latest)
+                time.sleep(1)
+        finally:
+            db.close()
+
+    response = app.response_class(stream(), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
 
 
 # get dashboard
@@ -190,9 +306,11 @@ def get_db():
         g.db = sqlite3.connect(
             'damsafe.sqlite',
             detect_types=(sqlite3.PARSE_DECLTYPES |
-                          sqlite3.PARSE_COLNAMES)
+                          sqlite3.PARSE_COLNAMES),
+            cached_statements=128
         )
         g.db.row_factory = sqlite3.Row
+        g.db.executescript(DB_PRAGMAS)
 
     return g.db
 
@@ -215,6 +333,10 @@ def init_db_command():
     db = get_db()
     with app.open_resource('schema.sql') as f:
         db.executescript(f.read().decode('utf8'))
+    # index the status history so per-device latest-time lookups don't
+    # have to scan the whole table
+    db.execute('CREATE INDEX IF NOT EXISTS idx_ds_devid_time '
+               'ON device_status(device_id, time DESC)')
     click.echo('Initialized database.')
 
 
@@ -230,40 +352,93 @@ def server_command():
                       sqlite3.PARSE_COLNAMES)
     )
     db.row_factory = sqlite3.Row
-
-    while True:
-        # let the Flask app know we're alive
-        Path('server_alive').touch()
-
-        # get all device data and loop over devices
-        device_rows = db.execute('SELECT * FROM device').fetchall()
-        for row in device_rows:
-            # connect to the device
-            client = ModbusTcpClient(row['ip'])
-            new_status = True
-            error = 'none'
+    db.executescript(DB_PRAGMAS)
+
+    # keep one long-lived client per device IP so the TCP connection
+    # survives between poll cycles instead of redoing the handshake
+    clients = {}
+
+    # poll all the devices behind one IP with a single coil read,
+    # returning what to record in device_status for each of them
+    # (no database access here--this runs on a worker thread)
+    def poll_group(group):
+        # unpack the grouped-up device ids and coils for this IP
+        ip = group['ip']
+        ids = [int(i) for i in group['ids'].split(',')]
+        coils = [int(c) for c in group['coils'].split(',')]
+
+        # reuse the cached client for this IP, creating one if needed
+        client = clients.get(ip)
+        if client is None:
+            client = clients.setdefault(ip, ModbusTcpClient(ip))
+        new_status = True
+        error = 'none'
+        try:
+            # try pinging the devices, covering all their coils with
+            # one read instead of one round-trip per coil
+            client.connect()
+            start = min(coils)
+            count = max(coils) - start + 1
+            result = client.read_coils(start, count)
             try:
-                # try pinging the device
-                result = client.read_coils(row['coil'], 1)
-                try:
-                    # if there's an error, record it
-                    error_code = result.exception_code
-                    error = ModbusExceptions.decode(error_code)
-                except AttributeError:
-                    pass
-            except ConnectionException:
-                # if we can't connect, say it's down
-                new_status = False
-
-            # record our findings in the device_status table
-            with FileLock('db.lock'):
-                db.execute('INSERT INTO device_status (device_id, time, status, error)'
-                           'VALUES (?, datetime("now"), ?, ?)',
-                           (row['id'], new_status, error))
-                db.commit()
-
-        # sleep to avoid overwhelming the devices
-        time.sleep(5)
+                # if there's an error, record it
+                error_code = result.exception_code
+                error = ModbusExceptions.decode(error_code)
+            except AttributeError:
+                pass
+        except ConnectionException:
+            # if we can't connect, say it's down, and drop the client
+            # so the next cycle reopens the connection from scratch
+            new_status = False
+            client.close()
+            del clients[ip]
+        return [(device_id, new_status, error) for device_id in ids]
+
+    cycle = 0
+    while True:
+        # note when this cycle started, to hold the poll cadence
+        start = time.monotonic()
+
+        # gather the devices by IP and poll every IP in parallel, so one
+        # slow device can't drag the whole cycle past the 5-second period
+        groups = db.execute('SELECT ip,GROUP_CONCAT(id) AS ids,'
+                            'GROUP_CONCAT(coil) AS coils '
+                            'FROM device GROUP BY ip').fetchall()
+        results = []
+        if groups:
+            with ThreadPoolExecutor(max_workers=min(32, len(groups))) as executor:
+                for group_results in executor.map(poll_group, groups):
+                    results.extend(group_results)
+
+        # record our findings in the device_status table and let the
+        # Flask app know we're alive, all in the cycle's one transaction
+        def record():
+            with db:
+                db.execute("INSERT OR REPLACE INTO heartbeat (id, ts) "
+                           "VALUES (1, datetime('now'))")
+                if results:
+                    db.executemany('INSERT INTO device_status (device_id, time, status, error)'
+                                   "VALUES (?, CAST(strftime('%s','now') AS INTEGER), ?, ?)",
+                                   results)
+        retry_locked(record)
+
+        # once an hour, prune status history past a week old so the
+        # table (and its index) doesn't grow without bound
+        if cycle % 720 == 0:
+            def prune():
+                with db:
+                    db.execute("DELETE FROM device_status "
+                               "WHERE time < CAST(strftime('%s','now','-7 days') AS INTEGER)")
+            retry_locked(prune)
+        cycle += 1
+
+        # sleep out the rest of the 5-second period, so the cadence
+        # stays steady instead of drifting by the cycle's own runtime
+        remaining = start + 5 - time.monotonic()
+        if remaining < 0:
+            click.echo('Warning: poll cycle overran its 5-second period '
+                       'by {:.1f}s'.format(-remaining))
+        time.sleep(max(0, remaining))
 
 
 # ensure the app is linked to these
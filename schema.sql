@@ -1,5 +1,6 @@
 DROP TABLE IF EXISTS device;
 DROP TABLE IF EXISTS device_status;
+DROP TABLE IF EXISTS heartbeat;
 
 CREATE TABLE device (
   id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -8,9 +9,14 @@ CREATE TABLE device (
   coil INT
 );
 
+CREATE TABLE heartbeat (
+  id INTEGER PRIMARY KEY,
+  ts TIMESTAMP
+);
+
 CREATE TABLE device_status (
   device_id INTEGER,
-  time TIMESTAMP,
+  time INTEGER NOT NULL,
   status BOOLEAN,
   error TEXT,
   PRIMARY KEY(device_id,time),